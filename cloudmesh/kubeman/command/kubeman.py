@@ -1,6 +1,7 @@
 from signal import signal, SIGINT
 
 from cloudmesh.kubeman.kubeman import Kubeman
+from cloudmesh.kubeman.kubeman import WaitError
 
 from cloudmesh.common.console import Console
 from cloudmesh.common.debug import VERBOSE
@@ -81,7 +82,10 @@ class KubemanCommand(PluginCommand):
             k8.deploy_info()
         elif arguments["--token"]:
             k8 = Kubeman()
-            k8.get_token()
+            try:
+                k8.get_token()
+            except WaitError as e:
+                Console.error(str(e))
         elif arguments["--about"]:
             k8 = Kubeman()
             print(k8.LICENSE)
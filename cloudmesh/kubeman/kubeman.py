@@ -2,8 +2,10 @@
 Kubeman. Cloudmesh KUbemanager allows the easy management of pods and services for kubernetes.
 It has a small but very useful set of commands.
 """
+import json
 import os
 import textwrap
+import threading
 import time
 
 import cloudmesh.kubeman
@@ -16,9 +18,37 @@ from cloudmesh.common.util import str_banner
 from cloudmesh.kubeman.__version__ import version
 
 
+class WaitError(Exception):
+    """
+    raised when a wait loop detects a failed pod or passes its deadline.
+    The message contains a diagnostic summary of the pod.
+    """
+    pass
+
+
 class Kubeman:
     commands = {}
 
+    # kubectl and minikube subcommands that only read the cluster state
+    READ_COMMANDS = {
+        "kubectl": ["get", "describe", "logs", "top", "version", "cluster-info", "api-resources", "explain"],
+        "minikube": ["ip", "status", "version"],
+    }
+
+    # flags that keep a read command running until it is interrupted
+    FOLLOW_FLAGS = ["-f", "--follow", "-w", "--watch", "--watch-only"]
+
+    # filters that may follow a read command in a pipe
+    FILTERS = ["grep", "fgrep", "egrep", "awk", "head", "tail", "sort", "uniq", "wc", "cut"]
+
+    # container states from which a pod does not recover without a new deployment
+    FAILED_STATES = ["CrashLoopBackOff", "ImagePullBackOff", "InvalidImageName",
+                     "CreateContainerConfigError", "CreateContainerError", "RunContainerError"]
+
+    # container states kubelet retries, they fail a pod after RESTART_THRESHOLD restarts
+    RETRIED_STATES = ["ErrImagePull", "Error", "OOMKilled", "ContainerCannotRun"]
+    RESTART_THRESHOLD = 3
+
     @staticmethod
     def exit_handler(signal_received, frame):
         """
@@ -51,20 +81,41 @@ class Kubeman:
         """
         self.dashboard = dashboard
 
-    def __init__(self, dashboard=False):
+    def __init__(self, dashboard=False, ttl=1.0, driver=None, pending_timeout=300, history="history.txt"):
         """
         Set up cloudmesh kubeman. If the dashboard is set to TRue (default)
         the dashboard get displayed with the appropriate method.
 
         :param dashboard:
         :type dashboard:
+        :param ttl: seconds a read only query result is reused within the session
+        :type ttl: float
+        :param driver: a driver such as Recorder or Replayer through which all
+                       commands are run, None runs them directly
+        :type driver:
+        :param pending_timeout: seconds a pod may stay Pending in a wait loop
+                                before it is considered stuck
+        :type pending_timeout: float
+        :param history: the file the commands are logged in, None disables it
+        :type history: str
         """
         self.dashboard = dashboard
+        self.driver = driver
+        self.history = history
         # cloudmesh/kubemanager
-        self.screen = os.get_terminal_size()
+        try:
+            self.screen = os.get_terminal_size()
+        except OSError:
+            self.screen = os.terminal_size((79, 24))
         self.token = None
         self.ip = None
         self.LOCATION = cloudmesh.kubeman.__file__.replace("/__init__.py", "")
+        self.ttl = ttl
+        self.pending_timeout = pending_timeout
+        self.cache = {}
+        self.inflight = {}
+        self.generation = 0
+        self.lock = threading.Lock()
 
     def banner(self, msg):
         """
@@ -113,7 +164,7 @@ class Kubeman:
         self.banner("kill_services")
         try:
             if not keep_history:
-                os.remove("history.txt")
+                os.remove(self.history)
         except:
             pass
         #pid = self.find_pid("8001")
@@ -139,47 +190,249 @@ class Kubeman:
 
     def add_history(self, msg):
         """
-        add the msg to the history
+        add the msg to the history. The file is only synced when the commands
+        are run directly and not through a driver such as the Replayer.
 
         :param msg:
         :type msg:
         :return:
         :rtype:
         """
+        if self.history is None:
+            return
         m = msg.strip()
-        file = open("history.txt", "a")  # append mode
+        file = open(self.history, "a")  # append mode
         file.write(f"{msg}\n")
         file.close()
-        os.system("sync")
+        if self.driver is None:
+            os.system("sync")
+
+    @staticmethod
+    def matches(pod, name):
+        """
+        checks if the pod name contains name at dash separated boundaries,
+        so that web matches web-5d8f9-x2k4q and storm-web-1 but not
+        webhook-1. An empty name matches all pods.
+
+        :param pod:
+        :type pod: str
+        :param name:
+        :type name: str
+        :return:
+        :rtype: bool
+        """
+        return not name or f"-{name}-" in f"-{pod}-"
+
+    def get_pod_states(self, namespace=None):
+        """
+        returns the name, group, phase, container reasons and restarts of
+        the pods as reported by kubectl get pods -o json. Pods of the same
+        deployment, including those of older replica sets, share a group.
+        Warnings kubectl prints in front of the json are skipped.
+
+        :param namespace:
+        :type namespace:
+        :return:
+        :rtype: list of dict
+        """
+        if namespace is None:
+            command = "kubectl get pods -o json"
+        else:
+            command = f"kubectl -n {namespace} get pods -o json"
+        r = self.query(command, driver=Shell.run)
+        items = json.loads(r[r.find("{"):]).get("items", [])
+        pods = []
+        for item in items:
+            metadata = item["metadata"]
+            group = metadata["name"]
+            for owner in metadata.get("ownerReferences", [])[:1]:
+                if owner.get("kind") == "ReplicaSet":
+                    group = owner["name"].rsplit("-", 1)[0]
+                else:
+                    group = owner["name"]
+            status = item.get("status", {})
+            containers = status.get("initContainerStatuses", []) + status.get("containerStatuses", [])
+            reasons = []
+            if "reason" in status:
+                reasons.append(status["reason"])
+            for container in containers:
+                for state in ["waiting", "terminated"]:
+                    reason = container.get("state", {}).get(state, {}).get("reason")
+                    if reason is not None:
+                        reasons.append(reason)
+            pods.append({
+                "name": metadata["name"],
+                "group": group,
+                "phase": status.get("phase", "Unknown"),
+                "reasons": reasons,
+                "restarts": max([container.get("restartCount", 0) for container in containers], default=0)
+            })
+        return pods
+
+    def diagnose(self, pod, namespace=None, tail=20):
+        """
+        returns a summary of the last container state, the recent events
+        and the log tail of the pod. Commands that fail are noted in the
+        summary.
+
+        :param pod: a pod as returned by get_pod_states
+        :type pod: dict
+        :param namespace:
+        :type namespace:
+        :param tail: number of log and event lines
+        :type tail: int
+        :return:
+        :rtype: str
+        """
+        kubectl = "kubectl" if namespace is None else f"kubectl -n {namespace}"
+        try:
+            describe = self.query(f"{kubectl} describe pod {pod['name']}", driver=Shell.run).splitlines()
+        except RuntimeError as e:
+            describe = []
+            states = [f"describe unavailable: {str(e).strip()}"]
+        else:
+            states = [line.strip() for line in describe
+                      if line.strip().split(":")[0] in ["State", "Last State", "Reason", "Exit Code", "Message"]]
+        events = []
+        for index, line in enumerate(describe):
+            if line.startswith("Events:"):
+                events = describe[index + 1:][-tail:]
+                break
+        previous = " --previous" if pod["restarts"] > 0 else ""
+        try:
+            logs = self.query(f"{kubectl} logs --all-containers{previous} --tail={tail} {pod['name']}",
+                              driver=Shell.run).splitlines()[-tail:]
+        except RuntimeError as e:
+            logs = [f"logs unavailable: {str(e).strip()}"]
+        summary = ["# container state", *states, "# events", *events, "# logs", *logs]
+        return "\n".join(summary)
+
+    def pod_failure(self, pod, started=None):
+        """
+        returns why the pod failed, or None if it is still progressing. A pod
+        fails in the Failed phase, in a state it does not recover from, or
+        if it is in the Pending phase for longer than self.pending_timeout
+        seconds since started. States kubelet retries, such as Error or
+        ErrImagePull, fail the pod once it restarted RESTART_THRESHOLD times.
+
+        :param pod: a pod as returned by get_pod_states
+        :type pod: dict
+        :param started: the time the wait started
+        :type started: float
+        :return:
+        :rtype: str
+        """
+        failed = [reason for reason in pod["reasons"] if reason in self.FAILED_STATES]
+        retried = [reason for reason in pod["reasons"] if reason in self.RETRIED_STATES]
+        if pod["phase"] == "Failed":
+            return f"pod {pod['name']} failed: {', '.join(pod['reasons'])}"
+        elif failed:
+            return f"pod {pod['name']} is {failed[0]}, restarts: {pod['restarts']}"
+        elif retried and pod["restarts"] >= self.RESTART_THRESHOLD:
+            return f"pod {pod['name']} is {retried[0]}, restarts: {pod['restarts']}"
+        elif pod["phase"] == "Pending" and started is not None and \
+                self.now() - started > self.pending_timeout:
+            reason = f"pod {pod['name']} is Pending for more than {self.pending_timeout}s"
+            if pod["reasons"]:
+                reason = f"{reason}: {', '.join(pod['reasons'])}"
+            return reason
+        return None
+
+    def check_pods(self, name="", namespace=None, started=None):
+        """
+        raises a WaitError if the pods of a deployment that match name all
+        failed, see pod_failure. A failed pod is ignored as long as another
+        pod of its deployment is still progressing, so that stale pods of an
+        older replica set do not end the wait. Evicted and completed pods
+        are ignored. If kubectl fails or its output can not be read, for
+        example while the cluster starts, the pods are not checked.
+
+        :param name:
+        :type name:
+        :param namespace:
+        :type namespace:
+        :param started: the time the wait started
+        :type started: float
+        :return:
+        :rtype:
+        """
+        try:
+            pods = self.get_pod_states(namespace=namespace)
+        except (RuntimeError, ValueError):
+            return
+        failures = {}
+        progressing = set()
+        for pod in pods:
+            if not self.matches(pod["name"], name) or \
+                    "Evicted" in pod["reasons"] or pod["phase"] == "Succeeded":
+                continue
+            reason = self.pod_failure(pod, started=started)
+            if reason is None:
+                progressing.add(pod["group"])
+            else:
+                failures.setdefault(pod["group"], (pod, reason))
+        for group, (pod, reason) in failures.items():
+            if group not in progressing:
+                raise WaitError(f"{reason}\n{self.diagnose(pod, namespace=namespace)}")
+
+    def check_deadline(self, started, timeout, what):
+        """
+        raises a WaitError if more than timeout seconds passed since started
 
-    def get_token(self, admin="admin-user"):
+        :param started: the time the wait started
+        :type started: float
+        :param timeout: seconds, None waits forever
+        :type timeout: float
+        :param what: description of what is waited for
+        :type what: str
+        :return:
+        :rtype:
         """
-        find the administartion user token
+        if timeout is not None and self.now() - started > timeout:
+            raise WaitError(f"timeout after {timeout}s waiting for {what}")
+
+    def get_token(self, admin="admin-user", timeout=None):
+        """
+        find the administartion user token. While waiting for it the pods of
+        the dashboard are checked and a WaitError is raised if they fail.
 
         :param admin:
         :type admin:
+        :param timeout: seconds to wait for the token, None waits forever
+        :type timeout: float
         :return:
         :rtype:
         """
         if self.token is None:
+            started = self.now()
             Console.blue("TOKEN NAME")
             found = False
             while not found:
-                name = self.Shell_run(f"kubectl -n kubernetes-dashboard get secret | grep {admin}").split()[0]
+                try:
+                    name = self.query(f"kubectl -n kubernetes-dashboard get secret | grep {admin}").split()[0]
+                except (RuntimeError, IndexError):
+                    # grep fails as long as the secret does not exist
+                    name = ""
                 if admin in name:
                     found = True
                 else:
-                    time.sleep(1)
+                    self.check_pods(namespace="kubernetes-dashboard", started=started)
+                    self.check_deadline(started, timeout, f"secret {admin}")
+                    self.sleep(1)
                     print (".")
 
             Console.blue("TOKEN")
             found = False
             while not found:
-                r = self.Shell_run(f"kubectl -n kubernetes-dashboard describe secret {name}")
+                try:
+                    r = self.query(f"kubectl -n kubernetes-dashboard describe secret {name}")
+                except RuntimeError:
+                    r = ""
                 if "token:" in r:
                     found = True
                 else:
-                    time.sleep(1)
+                    self.check_deadline(started, timeout, f"token of {name}")
+                    self.sleep(1)
                     print (".")
 
             lines = r.splitlines()
@@ -190,6 +443,157 @@ class Kubeman:
             self.token = line
         return self.token
 
+    def run(self, command, driver=Shell.run):
+        """
+        runs the command with the driver. If the session has a driver such as
+        a Recorder or Replayer, the command is passed through it.
+
+        :param command:
+        :type command:
+        :param driver:
+        :type driver:
+        :return:
+        :rtype:
+        """
+        if self.driver is None:
+            return driver(command)
+        return self.driver(command, driver=driver)
+
+    def sleep(self, seconds):
+        """
+        sleeps for the given seconds in the time of the session
+
+        :param seconds:
+        :type seconds:
+        :return:
+        :rtype:
+        """
+        if self.driver is None:
+            time.sleep(seconds)
+        else:
+            self.driver.sleep(seconds)
+
+    def now(self):
+        """
+        the current time of the session
+
+        :return:
+        :rtype: float
+        """
+        if self.driver is None:
+            return time.time()
+        return self.driver.now()
+
+    def is_query(self, command):
+        """
+        checks if the command only reads the cluster state. Such commands
+        can be coalesced and cached. Pipes into simple filters such as grep
+        are allowed, any other shell construct is considered mutating.
+        Commands that follow or watch never finish and are not queries.
+
+        :param command:
+        :type command:
+        :return:
+        :rtype: bool
+        """
+        if any(c in command for c in [";", "&", ">", "<", "`", "$("]):
+            return False
+        segments = command.split("|")
+        for segment in segments[1:]:
+            words = segment.split()
+            if not words or words[0] not in self.FILTERS:
+                return False
+        words = segments[0].split()
+        if not words or words[0] not in self.READ_COMMANDS:
+            return False
+        if any(word.split("=")[0] in self.FOLLOW_FLAGS for word in words):
+            return False
+        verb = None
+        skip = False
+        for word in words[1:]:
+            if skip:
+                skip = False
+            elif word in ["-n", "--namespace", "--context", "-p", "--profile"]:
+                skip = True
+            elif not word.startswith("-"):
+                verb = word
+                break
+        return verb in self.READ_COMMANDS[words[0]]
+
+    def invalidate(self):
+        """
+        forgets all cached query results. Queries that are in flight while
+        the cache is invalidated do not store their result.
+
+        :return:
+        :rtype:
+        """
+        with self.lock:
+            self.cache = {}
+            self.generation = self.generation + 1
+
+    def query(self, command, driver=None):
+        """
+        runs a read only command. Identical queries that run at the same
+        time are executed only once and their result is shared. Results
+        are reused for self.ttl seconds. Commands that are not read only
+        are passed on to Shell_run. Results are kept per driver, as
+        os.system returns the exit status and Shell.run the output.
+
+        :param command:
+        :type command:
+        :param driver: if None the command is run with Shell_run, otherwise
+                       the driver is called without adding to the history
+        :type driver:
+        :return:
+        :rtype:
+        """
+        if driver is None:
+            run = self.Shell_run
+        else:
+            def run(command):
+                return self.run(command, driver=driver)
+        if not self.is_query(command):
+            return run(command)
+        # Shell_run returns the same output as Shell.run
+        key = (driver or Shell.run, command)
+        with self.lock:
+            if key in self.cache:
+                timestamp, result = self.cache[key]
+                if self.now() - timestamp < self.ttl:
+                    return result
+            if key in self.inflight:
+                owner = False
+                flight = self.inflight[key]
+            else:
+                owner = True
+                flight = self.inflight[key] = {
+                    "event": threading.Event(),
+                    "result": None,
+                    "error": None,
+                    "generation": self.generation
+                }
+        if not owner:
+            flight["event"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["result"]
+        try:
+            result = run(command)
+        except BaseException as e:
+            flight["error"] = e
+            raise
+        else:
+            flight["result"] = result
+            with self.lock:
+                if flight["generation"] == self.generation:
+                    self.cache[key] = (self.now(), result)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight["event"].set()
+        return result
+
     def execute(self, commands, sleep_time=1, driver=os.system):
         """
         execute the given command and add it to the history.txt file
@@ -215,8 +619,17 @@ class Kubeman:
             if command.strip().startswith("#"):
                 Console.blue(command)
             else:
+                # invalidate before and after, so that queries running
+                # concurrently with the command do not cache the old state
+                mutating = not self.is_query(command)
+                if mutating:
+                    self.invalidate()
                 Console.blue(f"running: {command}")
-                r = driver(command)
+                try:
+                    r = self.run(command, driver=driver)
+                finally:
+                    if mutating:
+                        self.invalidate()
                 if driver == os.system:
                     if (str(r) == "0"):
                         print()
@@ -229,7 +642,7 @@ class Kubeman:
                     print(r)
 
                 result = result + str(r)
-                time.sleep(sleep_time)
+                self.sleep(sleep_time)
         return result
 
     def os_system(self, command):
@@ -288,7 +701,7 @@ class Kubeman:
         minikube start driver=docker
         """
         self.execute(script, driver=os.system)
-        time.sleep(sleep_time)
+        self.sleep(sleep_time)
         StopWatch.stop("setup_minikube")
 
     def setup_k8(self):
@@ -334,21 +747,25 @@ class Kubeman:
         :rtype:
         """
         if self.ip is None:
-            self.ip = self.Shell_run("minikube ip").strip()
+            self.ip = self.query("minikube ip").strip()
         return self.ip
 
-    def open_k8_dashboard(self, display=True):
+    def open_k8_dashboard(self, display=True, timeout=None):
         """
-        open the kubernetes daskboard
+        open the kubernetes daskboard. While waiting for it the pods of the
+        dashboard are checked and a WaitError is raised if they fail.
 
         :param display:
         :type display:
+        :param timeout: seconds to wait for the dashboard, None waits forever
+        :type timeout: float
         :return:
         :rtype:
         """
         self.banner("open_k8_dashboard")
         if self.dashboard or display:
-            token = self.get_token()
+            started = self.now()
+            token = self.get_token(timeout=timeout)
             self.hline()
             print("TOKEN")
             self.hline()
@@ -358,41 +775,55 @@ class Kubeman:
             # wait for the dashboard to be reachable
             while not found:
                 command = "curl http://localhost:8001/api/v1/namespaces/kubernetes-dashboard/services/https:kubernetes-dashboard:/proxy/#/login"
-                result = Shell.run(command)
+                try:
+                    result = self.run(command)
+                except RuntimeError:
+                    # the proxy is not yet reachable
+                    result = ""
                 found = "<title>Kubernetes Dashboard</title>" in result
-                time.sleep(1)
+                if not found:
+                    self.check_pods(namespace="kubernetes-dashboard", started=started)
+                    self.check_deadline(started, timeout, "the dashboard")
+                self.sleep(1)
                 print(".", end="")
 
             self.execute("gopen http://localhost:8001/api/v1/namespaces/kubernetes-dashboard/services/https:"
                          "kubernetes-dashboard:/proxy/#/login", driver=os.system)
 
-    def wait_for_pod(self, name, state="Running"):
+    def wait_for_pod(self, name, state="Running", timeout=None):
         """
-        wait for a specific pod to be in the state specified. The name will be searched for. It can be the partial name of a pod.
-        Make sure you implement and use a unique naming scheme.
+        wait for a specific pod to be in the state specified. The name will be searched for. It can be the partial name of a pod
+        between dashes, see matches. Make sure you implement and use a unique naming scheme.
+        A WaitError is raised if the pod fails, is stuck in Pending, or
+        the timeout passes. Failing kubectl commands are retried.
 
         :param name:
         :type name:
         :param state:
         :type state:
+        :param timeout: seconds to wait for the pod, None waits forever
+        :type timeout: float
         :return:
         :rtype:
         """
         print(f"Starting {name}: ")
+        started = self.now()
         found = False
         while not found:
             try:
-                r = Shell.run("kubectl get pods").splitlines()
-                r = Shell.find_lines_with(r, name)[0]
-                if state in r:
-                    found = True
-                    print(f"ok. Pod {name} {state}")
-                else:
-                    print(".", end="", flush=True)
-                    time.sleep(1)
-            except:
+                r = self.query("kubectl get pods", driver=Shell.run).splitlines()
+                r = [line for line in r if line.split() and self.matches(line.split()[0], name)]
+            except RuntimeError:
+                # kubectl is not yet reachable, for example after minikube start
+                r = []
+            if any(state in line for line in r):
+                found = True
+                print(f"ok. Pod {name} {state}")
+            else:
+                self.check_pods(name, started=started)
+                self.check_deadline(started, timeout, f"pod {name} {state}")
                 print(".", end="", flush=True)
-                time.sleep(1)
+                self.sleep(1)
 
     def menu(self, steps):
         """
@@ -440,7 +871,7 @@ class Kubeman:
         :return:
         :rtype:
         """
-        return self.Shell_run(f"kubectl get pods")
+        return self.query("kubectl get pods")
 
     def get_services(self):
         """
@@ -449,7 +880,7 @@ class Kubeman:
         :return:
         :rtype:
         """
-        return self.Shell_run(f"kubectl get services")
+        return self.query("kubectl get services")
 
     def deploy_info(self):
         """
@@ -0,0 +1,227 @@
+"""
+Record and replay drivers for Kubeman. A Recorder runs the commands of a
+session and stores their output, exit code and duration in a yaml fixture.
+A Replayer serves the commands from such a fixture without a cluster, so
+that workflows can be developed and profiled offline. The install
+location of cloudmesh kubeman is stored as {LOCATION}, so that fixtures
+can be replayed on other machines.
+
+    k8 = Kubeman(driver=Recorder("session.yaml"))
+    k8.setup_k8()
+
+    k8 = Kubeman(driver=Replayer("session.yaml", scale=0), history=None)
+    k8.setup_k8()
+"""
+import os
+import time
+
+import yaml
+import cloudmesh.kubeman
+from cloudmesh.common.Shell import Shell
+
+LOCATION = cloudmesh.kubeman.__file__.replace("/__init__.py", "")
+
+
+def driver_name(driver):
+    """
+    returns the name under which the commands of a driver are recorded
+
+    :param driver:
+    :type driver:
+    :return:
+    :rtype: str
+    """
+    if driver == os.system:
+        return "os.system"
+    elif driver == Shell.run:
+        return "Shell.run"
+    name = getattr(driver, "__name__", None)
+    if name is None or name == "<lambda>":
+        raise ValueError(f"driver can not be recorded, it has no name: {driver}")
+    return name
+
+
+def split_error(error):
+    """
+    splits the RuntimeError raised by Shell.run for a failing command
+    into its exit code and output
+
+    :param error:
+    :type error: RuntimeError
+    :return: exit code, output
+    :rtype: int, str
+    """
+    code, _, output = str(error).partition(" ")
+    try:
+        return int(code), output
+    except ValueError:
+        return 1, str(error)
+
+
+class Recorder:
+
+    def __init__(self, filename, location=LOCATION):
+        """
+        records all commands of a session in the given yaml file. Each
+        command is appended to the file as soon as it finished.
+
+        :param filename:
+        :type filename:
+        :param location: the path that is recorded as {LOCATION}
+        :type location: str
+        """
+        self.filename = filename
+        self.location = location
+        open(self.filename, "w").close()
+
+    def __call__(self, command, driver=Shell.run):
+        """
+        runs the command with the driver and records the result. If
+        Shell.run fails, its exit code and output are recorded and the
+        RuntimeError is raised again.
+
+        :param command:
+        :type command:
+        :param driver:
+        :type driver:
+        :return: the result of the driver
+        :rtype:
+        """
+        name = driver_name(driver)
+        error = None
+        start = time.time()
+        try:
+            result = driver(command)
+        except RuntimeError as e:
+            error = e
+            code, result = split_error(e)
+        elapsed = time.time() - start
+        if error is None:
+            if driver == os.system:
+                code = os.waitstatus_to_exitcode(result)
+            else:
+                code = 0
+        if isinstance(result, str):
+            recorded = result.replace(self.location, "{LOCATION}")
+        else:
+            recorded = result
+        self.save({
+            "command": command.replace(self.location, "{LOCATION}"),
+            "driver": name,
+            "result": recorded,
+            "exit": code,
+            "time": round(elapsed, 6)
+        })
+        if error is not None:
+            raise error
+        return result
+
+    def save(self, entry):
+        """
+        appends the entry to the file
+
+        :param entry:
+        :type entry: dict
+        :return:
+        :rtype:
+        """
+        with open(self.filename, "a") as f:
+            yaml.safe_dump([entry], f, sort_keys=False)
+
+    def sleep(self, seconds):
+        """
+        sleeps for the given seconds
+
+        :param seconds:
+        :type seconds:
+        :return:
+        :rtype:
+        """
+        time.sleep(seconds)
+
+    def now(self):
+        """
+        the time of the session
+
+        :return:
+        :rtype: float
+        """
+        return time.time()
+
+
+class Replayer:
+
+    def __init__(self, filename, scale=0.0, location=LOCATION):
+        """
+        replays the commands recorded in the given yaml file. The recorded
+        latency and all sleeps of the session are multiplied with scale,
+        so scale=0 replays instantly and scale=1 in real time.
+
+        :param filename:
+        :type filename:
+        :param scale:
+        :type scale: float
+        :param location: the path {LOCATION} is replaced with
+        :type location: str
+        """
+        self.filename = filename
+        self.scale = scale
+        self.clock = time.time()
+        self.entries = {}
+        with open(filename) as f:
+            for entry in yaml.safe_load(f) or []:
+                entry["command"] = entry["command"].replace("{LOCATION}", location)
+                if isinstance(entry["result"], str):
+                    entry["result"] = entry["result"].replace("{LOCATION}", location)
+                key = (entry["driver"], entry["command"])
+                self.entries.setdefault(key, []).append(entry)
+
+    def __call__(self, command, driver=Shell.run):
+        """
+        returns the recorded result of the command. Repeated commands are
+        served in the recorded order, once exhausted the last result is
+        repeated, which lets wait loops finish. Commands that failed in
+        Shell.run raise the same RuntimeError again.
+
+        :param command:
+        :type command:
+        :param driver:
+        :type driver:
+        :return: the recorded result
+        :rtype:
+        """
+        key = (driver_name(driver), command)
+        if key not in self.entries:
+            raise ValueError(f"command not recorded in {self.filename}: {command}")
+        entries = self.entries[key]
+        if len(entries) > 1:
+            entry = entries.pop(0)
+        else:
+            entry = entries[0]
+        self.sleep(entry["time"])
+        if entry["driver"] == "Shell.run" and entry["exit"] != 0:
+            raise RuntimeError(f"{entry['exit']} {entry['result']}")
+        return entry["result"]
+
+    def sleep(self, seconds):
+        """
+        advances the session time and sleeps for the scaled seconds
+
+        :param seconds:
+        :type seconds:
+        :return:
+        :rtype:
+        """
+        self.clock = self.clock + seconds
+        if self.scale:
+            time.sleep(seconds * self.scale)
+
+    def now(self):
+        """
+        the time of the replayed session, which advances with the recorded
+        latencies and sleeps instead of the wall clock
+
+        :return:
+        :rtype: float
+        """
+        return self.clock
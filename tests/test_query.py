@@ -0,0 +1,150 @@
+###############################################################
+# pytest -v --capture=no tests/test_query.py
+# pytest -v  tests/test_query.py
+###############################################################
+import threading
+import time
+
+import pytest
+from cloudmesh.kubeman.kubeman import Kubeman
+
+
+@pytest.fixture
+def k8(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return Kubeman(ttl=60)
+
+
+class Counter:
+
+    def __init__(self, result="NAME READY STATUS", delay=0.0):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, command):
+        with self.lock:
+            self.calls = self.calls + 1
+        time.sleep(self.delay)
+        return self.result
+
+
+@pytest.mark.parametrize("command, expected", [
+    ("kubectl get pods", True),
+    ("kubectl -n kubernetes-dashboard get secret | grep admin-user", True),
+    ("kubectl -n kubernetes-dashboard describe secret admin", True),
+    ("minikube ip", True),
+    ("kubectl apply -f account.yaml", False),
+    ("kubectl create -f role.yaml", False),
+    ("minikube stop", False),
+    ("kubectl proxy &", False),
+    ("kubectl get pods > pods.txt", False),
+    ("kubectl get pods | xargs kubectl delete pod", False),
+    ("kubectl get pods -w", False),
+    ("kubectl get pods --watch", False),
+    ("kubectl logs -f web", False),
+    ("kubectl logs --follow=true web", False),
+])
+def test_is_query(k8, command, expected):
+    assert k8.is_query(command) == expected
+
+
+def test_single_flight(k8):
+    driver = Counter(delay=0.3)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(k8.query("kubectl get pods", driver=driver)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert driver.calls == 1
+    assert results == [driver.result] * 5
+
+
+def test_ttl(k8):
+    driver = Counter()
+    k8.query("kubectl get pods", driver=driver)
+    k8.query("kubectl get pods", driver=driver)
+    assert driver.calls == 1
+    k8.ttl = 0
+    k8.query("kubectl get pods", driver=driver)
+    assert driver.calls == 2
+
+
+def test_mutating_command_is_not_cached(k8):
+    driver = Counter()
+    k8.query("kubectl delete pod web", driver=driver)
+    k8.query("kubectl delete pod web", driver=driver)
+    assert driver.calls == 2
+
+
+def test_execute_invalidates(k8):
+    driver = Counter()
+    k8.query("kubectl get pods", driver=driver)
+    k8.execute("true", sleep_time=0)
+    k8.query("kubectl get pods", driver=driver)
+    assert driver.calls == 2
+
+
+def test_invalidate_during_command(k8):
+    # a query that runs while a mutating command is in progress must not
+    # serve its result after the command finished
+    driver = Counter()
+
+    def apply(command):
+        k8.query("kubectl get pods", driver=driver)
+        return 0
+
+    k8.execute("kubectl apply -f account.yaml", sleep_time=0, driver=apply)
+    k8.query("kubectl get pods", driver=driver)
+    assert driver.calls == 2
+
+
+def test_interrupt_is_not_cached(k8):
+    def interrupted(command):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        k8.query("kubectl get pods", driver=interrupted)
+    assert k8.cache == {}
+    assert k8.inflight == {}
+    driver = Counter()
+    assert k8.query("kubectl get pods", driver=driver) == driver.result
+
+
+def test_waiters_reraise(k8):
+    started = threading.Event()
+
+    def failing(command):
+        started.set()
+        time.sleep(0.3)
+        raise RuntimeError("1 connection refused")
+
+    errors = []
+
+    def waiter():
+        try:
+            k8.query("kubectl get pods", driver=failing)
+        except RuntimeError as e:
+            errors.append(e)
+
+    owner = threading.Thread(target=waiter)
+    owner.start()
+    started.wait()
+    other = threading.Thread(target=waiter)
+    other.start()
+    owner.join()
+    other.join()
+    assert len(errors) == 2
+
+
+def test_cache_per_driver(k8):
+    output = Counter(result="NAME READY STATUS")
+    status = Counter(result=0)
+    assert k8.query("kubectl get pods", driver=output) == output.result
+    assert k8.query("kubectl get pods", driver=status) == 0
+    assert k8.query("kubectl get pods", driver=output) == output.result
+    assert output.calls == 1
+    assert status.calls == 1
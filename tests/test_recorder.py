@@ -0,0 +1,139 @@
+###############################################################
+# pytest -v --capture=no tests/test_recorder.py
+# pytest -v  tests/test_recorder.py
+###############################################################
+import os
+import time
+
+import pytest
+import yaml
+from cloudmesh.common.Shell import Shell
+from cloudmesh.kubeman.kubeman import Kubeman
+from cloudmesh.kubeman.recorder import Recorder
+from cloudmesh.kubeman.recorder import Replayer
+
+
+def session(k8):
+    """
+    a small session with successful and failing commands of both drivers
+    """
+    results = [
+        k8.execute("echo hello", sleep_time=0, driver=Shell.run),
+        k8.execute("true", sleep_time=0, driver=os.system),
+        k8.execute("false", sleep_time=0, driver=os.system),
+    ]
+    try:
+        k8.execute("echo hello | grep missing", sleep_time=0, driver=Shell.run)
+    except RuntimeError as e:
+        results.append(str(e))
+    return results
+
+
+@pytest.fixture
+def fixture(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return str(tmp_path / "session.yaml")
+
+
+def test_record(fixture):
+    k8 = Kubeman(driver=Recorder(fixture), history=None)
+    session(k8)
+    with open(fixture) as f:
+        entries = yaml.safe_load(f)
+    assert [entry["command"] for entry in entries] == [
+        "echo hello", "true", "false", "echo hello | grep missing"]
+    assert [entry["exit"] for entry in entries] == [0, 0, 1, 1]
+    assert entries[0]["result"] == "hello\n"
+    assert entries[0]["driver"] == "Shell.run"
+    assert entries[1]["driver"] == "os.system"
+
+
+def test_round_trip(fixture):
+    recorded = session(Kubeman(driver=Recorder(fixture), history=None))
+    start = time.time()
+    replayed = session(Kubeman(driver=Replayer(fixture), history=None))
+    assert replayed == recorded
+    assert time.time() - start < 0.5
+
+
+def test_not_recorded(fixture):
+    session(Kubeman(driver=Recorder(fixture), history=None))
+    k8 = Kubeman(driver=Replayer(fixture), history=None)
+    with pytest.raises(ValueError):
+        k8.execute("echo other", sleep_time=0, driver=Shell.run)
+
+
+def test_repeated_commands(fixture):
+    with open(fixture, "w") as f:
+        yaml.safe_dump([
+            {"command": "kubectl get pods", "driver": "Shell.run", "result": "Pending", "exit": 0, "time": 0.5},
+            {"command": "kubectl get pods", "driver": "Shell.run", "result": "Running", "exit": 0, "time": 0.5},
+        ], f)
+    replayer = Replayer(fixture)
+    start = replayer.now()
+    assert replayer("kubectl get pods") == "Pending"
+    assert replayer("kubectl get pods") == "Running"
+    assert replayer("kubectl get pods") == "Running"
+    assert replayer.now() - start == pytest.approx(1.5)
+
+
+def test_scale(fixture):
+    with open(fixture, "w") as f:
+        yaml.safe_dump([
+            {"command": "minikube ip", "driver": "Shell.run", "result": "192.168.49.2", "exit": 0, "time": 1.0},
+        ], f)
+    replayer = Replayer(fixture, scale=0.1)
+    start = time.time()
+    assert replayer("minikube ip") == "192.168.49.2"
+    assert time.time() - start >= 0.1
+
+
+def test_history(fixture):
+    Kubeman(history=None).add_history("echo hello")
+    assert not os.path.exists("history.txt")
+    Kubeman().add_history("echo hello")
+    with open("history.txt") as f:
+        assert f.read() == "echo hello\n"
+
+
+KUBECTL = """#!/bin/sh
+case "$*" in
+  *"get secret"*) echo "admin-user-token-x8k2p   kubernetes.io/service-account-token   3   1m" ;;
+  *"describe secret"*) printf "Name: admin-user-token-x8k2p\\ntoken:      eyJhbGciOi\\n" ;;
+  *) echo "kubectl $*" ;;
+esac
+"""
+
+
+def test_setup_k8(fixture, tmp_path, monkeypatch):
+    # record setup_k8 against a fake kubectl and replay it with cloudmesh
+    # kubeman installed at another location
+    path = tmp_path / "bin"
+    path.mkdir()
+    kubectl = path / "kubectl"
+    kubectl.write_text(KUBECTL)
+    kubectl.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{path}:{os.environ['PATH']}")
+    monkeypatch.setattr(Recorder, "sleep", lambda self, seconds: None)
+
+    k8 = Kubeman(driver=Recorder(fixture), history=None)
+    k8.setup_k8()
+    assert k8.token == "eyJhbGciOi"
+    with open(fixture) as f:
+        recorded = f.read()
+    assert "kubectl create -f {LOCATION}/account.yaml" in recorded
+    assert k8.LOCATION not in recorded
+
+    location = "/opt/venv/lib/python3.11/site-packages/cloudmesh/kubeman"
+    k8 = Kubeman(driver=Replayer(fixture, location=location), history=None)
+    k8.LOCATION = location
+    k8.setup_k8()
+    assert k8.token == "eyJhbGciOi"
+
+
+def test_unnamed_driver(fixture):
+    recorder = Recorder(fixture)
+    with pytest.raises(ValueError):
+        recorder("echo hello", driver=lambda command: command)
+    with open(fixture) as f:
+        assert f.read() == ""
@@ -0,0 +1,229 @@
+###############################################################
+# pytest -v --capture=no tests/test_wait.py
+# pytest -v  tests/test_wait.py
+###############################################################
+import json
+
+import pytest
+import yaml
+from cloudmesh.kubeman.kubeman import Kubeman
+from cloudmesh.kubeman.kubeman import WaitError
+from cloudmesh.kubeman.recorder import Replayer
+
+
+def entry(command, result, exit=0):
+    return {"command": command, "driver": "Shell.run", "result": result, "exit": exit, "time": 0.0}
+
+
+def pod(name="web-1", phase="Running", waiting=None, terminated=None, restarts=0, reason=None, owner=None):
+    """
+    a pod as listed by kubectl get pods -o json
+    """
+    state = {}
+    if waiting is not None:
+        state["waiting"] = {"reason": waiting}
+    if terminated is not None:
+        state["terminated"] = {"reason": terminated}
+    metadata = {"name": name}
+    if owner is not None:
+        metadata["ownerReferences"] = [{"kind": "ReplicaSet", "name": owner}]
+    status = {
+        "phase": phase,
+        "containerStatuses": [{"name": "web", "state": state, "restartCount": restarts}]
+    }
+    if reason is not None:
+        status["reason"] = reason
+    return {"metadata": metadata, "status": status}
+
+
+def poll(*pods, namespace=None, warning=""):
+    """
+    the output of kubectl for one iteration of a wait loop
+    """
+    kubectl = "kubectl" if namespace is None else f"kubectl -n {namespace}"
+    table = "NAME    READY   STATUS    RESTARTS   AGE\n"
+    for p in pods:
+        state = p["status"]["containerStatuses"][0]["state"]
+        status = p["status"].get("reason") or p["status"]["phase"]
+        for reason in [s["reason"] for s in state.values()]:
+            status = reason
+        table += f"{p['metadata']['name']}   0/1   {status}   0   1m\n"
+    return [
+        entry(f"{kubectl} get pods", table),
+        entry(f"{kubectl} get pods -o json", warning + json.dumps({"items": list(pods)}))
+    ]
+
+
+DESCRIBE = entry("kubectl describe pod web-1", "\n".join([
+    "Name:         web-1",
+    "    State:          Waiting",
+    "      Reason:       CrashLoopBackOff",
+    "    Last State:     Terminated",
+    "      Exit Code:    1",
+    "Events:",
+    "  Warning  BackOff  kubelet  Back-off restarting failed container",
+]))
+
+
+@pytest.fixture
+def kubectl(tmp_path, monkeypatch):
+    """
+    returns a function that creates a Kubeman replaying the scripted kubectl output
+    """
+    monkeypatch.chdir(tmp_path)
+
+    def script(entries, **kwargs):
+        filename = str(tmp_path / "kubectl.yaml")
+        with open(filename, "w") as f:
+            yaml.safe_dump(entries, f)
+        return Kubeman(driver=Replayer(filename), history=None, **kwargs)
+
+    return script
+
+
+def test_running(kubectl):
+    k8 = kubectl([
+        *poll(pod(phase="Pending", waiting="ContainerCreating")),
+        *poll(pod())])
+    k8.wait_for_pod("web")
+
+
+def test_crash_loop(kubectl):
+    k8 = kubectl([
+        *poll(pod(phase="Pending", waiting="ContainerCreating")),
+        *poll(pod(waiting="CrashLoopBackOff", restarts=3)),
+        DESCRIBE,
+        entry("kubectl logs --all-containers --previous --tail=20 web-1", "panic: boom\n")])
+    with pytest.raises(WaitError) as e:
+        k8.wait_for_pod("web")
+    message = str(e.value)
+    assert "pod web-1 is CrashLoopBackOff, restarts: 3" in message
+    assert "Exit Code:    1" in message
+    assert "Back-off restarting failed container" in message
+    assert "panic: boom" in message
+
+
+def test_image_pull_back_off(kubectl):
+    k8 = kubectl([
+        *poll(pod(phase="Pending", waiting="ImagePullBackOff")),
+        DESCRIBE,
+        entry("kubectl logs --all-containers --tail=20 web-1",
+              'Error from server (BadRequest): container "web" in pod "web-1" is waiting to start', exit=1)])
+    with pytest.raises(WaitError) as e:
+        k8.wait_for_pod("web")
+    message = str(e.value)
+    assert "pod web-1 is ImagePullBackOff" in message
+    assert "logs unavailable: 1 Error from server (BadRequest)" in message
+
+
+def test_retried_error(kubectl):
+    # kubelet restarts a container that exits with an error, so a single
+    # Error does not end the wait
+    k8 = kubectl([
+        *poll(pod(terminated="Error", restarts=0)),
+        *poll(pod(phase="Pending", waiting="ErrImagePull")),
+        *poll(pod(restarts=1))])
+    k8.wait_for_pod("web")
+
+
+def test_stuck_pending(kubectl):
+    k8 = kubectl([
+        *poll(pod(phase="Pending", waiting="ContainerCreating")),
+        DESCRIBE,
+        entry("kubectl logs --all-containers --tail=20 web-1", "")],
+        pending_timeout=30)
+    with pytest.raises(WaitError) as e:
+        k8.wait_for_pod("web")
+    assert "pod web-1 is Pending for more than 30s: ContainerCreating" in str(e.value)
+
+
+def test_timeout(kubectl):
+    k8 = kubectl(poll(pod()))
+    with pytest.raises(WaitError) as e:
+        k8.wait_for_pod("web", state="Completed", timeout=5)
+    assert "timeout after 5s waiting for pod web Completed" in str(e.value)
+
+
+def test_kubectl_unavailable(kubectl):
+    refused = "The connection to the server localhost:8080 was refused"
+    k8 = kubectl([
+        entry("kubectl get pods", refused, exit=1),
+        entry("kubectl get pods -o json", refused, exit=1),
+        *poll(pod())])
+    k8.wait_for_pod("web")
+
+
+def test_token_missing(kubectl):
+    k8 = kubectl([
+        entry("kubectl -n kubernetes-dashboard get secret | grep admin-user", "", exit=1),
+        entry("kubectl -n kubernetes-dashboard get pods -o json", json.dumps({"items": []})),
+    ])
+    with pytest.raises(WaitError) as e:
+        k8.get_token(timeout=3)
+    assert "timeout after 3s waiting for secret admin-user" in str(e.value)
+
+
+def test_warning_before_json(kubectl):
+    warning = "W1019 10:00:00.000000   1234 warnings.go:70] v1 ComponentStatus is deprecated in v1.19+\n"
+    k8 = kubectl([
+        *poll(pod(waiting="CrashLoopBackOff", restarts=3), warning=warning),
+        DESCRIBE,
+        entry("kubectl logs --all-containers --previous --tail=20 web-1", "")])
+    with pytest.raises(WaitError) as e:
+        k8.wait_for_pod("web", timeout=5)
+    assert "pod web-1 is CrashLoopBackOff" in str(e.value)
+
+
+def test_unreadable_json(kubectl):
+    k8 = kubectl([
+        entry("kubectl get pods", "NAME    READY   STATUS    RESTARTS   AGE\n"),
+        entry("kubectl get pods -o json", "error: unexpected output"),
+        *poll(pod())])
+    k8.wait_for_pod("web", timeout=5)
+
+
+def test_evicted(kubectl):
+    k8 = kubectl([
+        *poll(pod(name="web-5d8f9-old", phase="Failed", reason="Evicted", owner="web-5d8f9"),
+              pod(name="web-5d8f9-new", phase="Pending", waiting="ContainerCreating", owner="web-5d8f9")),
+        *poll(pod(name="web-5d8f9-old", phase="Failed", reason="Evicted", owner="web-5d8f9"),
+              pod(name="web-5d8f9-new", owner="web-5d8f9"))])
+    k8.wait_for_pod("web")
+
+
+def test_old_replica_set(kubectl):
+    # a crashing pod of the previous replica set does not end the wait
+    # while the pod of the new replica set comes up
+    k8 = kubectl([
+        *poll(pod(name="web-11111-a", waiting="CrashLoopBackOff", restarts=5, owner="web-11111"),
+              pod(name="web-22222-b", phase="Pending", waiting="ContainerCreating", owner="web-22222")),
+        *poll(pod(name="web-11111-a", waiting="CrashLoopBackOff", restarts=5, owner="web-11111"),
+              pod(name="web-22222-b", owner="web-22222"))])
+    k8.wait_for_pod("web")
+
+
+def test_other_pods(kubectl):
+    k8 = kubectl([
+        *poll(pod(name="webhook-1", waiting="CrashLoopBackOff", restarts=5),
+              pod(name="web-1", phase="Pending", waiting="ContainerCreating")),
+        *poll(pod(name="webhook-1", waiting="CrashLoopBackOff", restarts=5),
+              pod(name="web-1"))])
+    k8.wait_for_pod("web")
+
+
+def test_dashboard_crash(kubectl):
+    # one failing deployment in the namespace ends the wait, even if the
+    # pods of another deployment are running
+    namespace = "kubernetes-dashboard"
+    k8 = kubectl([
+        entry("kubectl -n kubernetes-dashboard get secret | grep admin-user", "", exit=1),
+        *poll(pod(name="kubernetes-dashboard-7d8f9-x", waiting="CrashLoopBackOff", restarts=3,
+                  owner="kubernetes-dashboard-7d8f9"),
+              pod(name="dashboard-metrics-scraper-5c4f8-y", owner="dashboard-metrics-scraper-5c4f8"),
+              namespace=namespace)[1:],
+        entry("kubectl -n kubernetes-dashboard describe pod kubernetes-dashboard-7d8f9-x", ""),
+        entry("kubectl -n kubernetes-dashboard logs --all-containers --previous --tail=20 "
+              "kubernetes-dashboard-7d8f9-x", "")])
+    with pytest.raises(WaitError) as e:
+        k8.get_token(timeout=5)
+    assert "pod kubernetes-dashboard-7d8f9-x is CrashLoopBackOff" in str(e.value)